@@ -1,10 +1,31 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
+import pydeck as pdk
+from PIL import Image
 from sqlalchemy import create_engine, text
-from datetime import datetime
-import gc
+from psycopg2.extensions import adapt
+from urllib.parse import quote
+from datetime import datetime, timedelta
+import base64
+import hashlib
+import io
+import os
+import re
+import shutil
+import uuid
+
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
 
 def configurar_pagina():
     st.set_page_config(
@@ -14,8 +35,42 @@ def configurar_pagina():
         initial_sidebar_state="expanded"
     )
 
-def aplicar_estilos_customizados():
-    tema_customizado = go.layout.Template(
+ESTILOS_CSS = """
+<style>
+    .main-header {
+        font-size: 2.5rem;
+        color: #1E3A8A;
+        text-align: center;
+        margin-bottom: 1.5rem;
+    }
+    .sub-header {
+        font-size: 1.75rem;
+        color: #1E3A8A;
+        margin-top: 2rem;
+        margin-bottom: 1rem;
+        padding-bottom: 0.5rem;
+        border-bottom: 2px solid #DBEAFE;
+    }
+    .footer {
+        text-align: center;
+        margin-top: 3rem;
+        padding: 1rem;
+        border-top: 1px solid #E5E7EB;
+        color: #6B7280;
+        font-size: 0.9rem;
+    }
+    .filter-summary {
+        background-color: #F3F4F6;
+        padding: 10px;
+        border-radius: 5px;
+        margin-bottom: 20px;
+    }
+</style>
+"""
+
+@st.cache_resource
+def construir_tema_plotly():
+    return go.layout.Template(
         layout=dict(
             font=dict(family="Arial, sans-serif", color="#333"),
             title=dict(font=dict(family="Arial, sans-serif", size=22, color="#1E3A8A"), x=0.5),
@@ -36,82 +91,568 @@ def aplicar_estilos_customizados():
             ),
         )
     )
-    px.defaults.template = tema_customizado
-
-    st.markdown("""
-    <style>
-        .main-header {
-            font-size: 2.5rem;
-            color: #1E3A8A;
-            text-align: center;
-            margin-bottom: 1.5rem;
-        }
-        .sub-header {
-            font-size: 1.75rem;
-            color: #1E3A8A;
-            margin-top: 2rem;
-            margin-bottom: 1rem;
-            padding-bottom: 0.5rem;
-            border-bottom: 2px solid #DBEAFE;
-        }
-        .stTabs [data-baseweb="tab-list"] {
-            gap: 5px;
-            border-bottom: 2px solid #DBEAFE;
-        }
-        .stTabs [data-baseweb="tab"] {
-            height: 50px;
-            background-color: #F3F4F6;
-            border-radius: 8px 8px 0 0;
-            padding: 10px 20px;
-            transition: all 0.2s ease-in-out;
-        }
-        .stTabs [aria-selected="true"] {
-            background-color: #DBEAFE;
-            color: #1E3A8A;
-            font-weight: bold;
-            border-bottom: 2px solid #2563EB;
-        }
-        .footer {
-            text-align: center;
-            margin-top: 3rem;
-            padding: 1rem;
-            border-top: 1px solid #E5E7EB;
-            color: #6B7280;
-            font-size: 0.9rem;
-        }
-        .filter-summary {
-            background-color: #F3F4F6;
-            padding: 10px;
-            border-radius: 5px;
-            margin-bottom: 20px;
-        }
-    </style>
-    """, unsafe_allow_html=True)
 
-@st.cache_resource(ttl=3600)
+px.defaults.template = construir_tema_plotly()
+
+def aplicar_estilos_customizados():
+    # O Streamlit descarta elementos não reenviados no rerun, então o <style> precisa sair em toda execução;
+    # o texto é uma constante do módulo e o tema já foi definido na importação
+    st.markdown(ESTILOS_CSS, unsafe_allow_html=True)
+
+DIRETORIO_MIGRACOES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Uma vez por processo (cache_resource sem ttl), nunca a cada rerun
+@st.cache_resource
+def aplicar_migracoes(_engine):
+    # Scripts idempotentes (tipo de ano_pib, índices). Sem permissão de DDL eles falham com aviso e as consultas
+    # se adaptam ao tipo real de ano_pib (obter_expr_ano_pib), sem depender da migração
+    if not os.path.isdir(DIRETORIO_MIGRACOES):
+        return
+    for nome_arquivo in sorted(os.listdir(DIRETORIO_MIGRACOES)):
+        if not nome_arquivo.endswith('.sql'):
+            continue
+        with open(os.path.join(DIRETORIO_MIGRACOES, nome_arquivo), encoding='utf-8') as arquivo:
+            script = arquivo.read()
+        try:
+            with _engine.begin() as connection:
+                connection.exec_driver_sql(script)
+        except Exception as e:
+            st.warning(f"Migração {nome_arquivo} não aplicada: {e}")
+
+TIMEOUT_CONSULTA_MS = 30_000
+OPCOES_CONEXAO = f"-c statement_timeout={TIMEOUT_CONSULTA_MS}"
+
+# Engine única por processo (cache_resource sem ttl): todas as sessões compartilham o mesmo pool de conexões;
+# o pool_recycle renova as conexões, não é preciso recriar a engine
+@st.cache_resource
 def obter_engine_db():
     try:
         db_credentials = st.secrets["postgres"]
         conn_string = (
             f"postgresql+psycopg2://{db_credentials['user']}:{db_credentials['password']}"
             f"@{db_credentials['host']}:{db_credentials['port']}/{db_credentials['database']}"
+            f"?sslmode={db_credentials.get('sslmode', 'require')}"
+        )
+        engine = create_engine(
+            conn_string,
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            connect_args={'options': OPCOES_CONEXAO},
         )
-        return create_engine(conn_string)
+        aplicar_migracoes(engine)
+        return engine
     except Exception as e:
         st.error(f"Falha na conexão com o banco de dados: {e}")
         return None
 
+TIPOS_INTEIROS_PG = ('smallint', 'integer', 'bigint')
+
+@st.cache_resource(ttl=3600)
+def obter_expr_ano_pib(_engine):
+    # Se a migração 001 não rodou, ano_pib continua textual e o CAST precisa ficar nas consultas
+    try:
+        with _engine.connect() as connection:
+            tipo = connection.execute(text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = 'pib_municipios' AND column_name = 'ano_pib'"
+            )).scalar()
+    except Exception:
+        tipo = None
+    return "p.ano_pib" if tipo in TIPOS_INTEIROS_PG else "CAST(p.ano_pib AS INTEGER)"
+
+EXPR_POPULACAO_ESTIMADA = "COALESCE(TRUNC(p.vl_pib / NULLIF(p.vl_pib_per_capta, 0)), 0)::integer"
+
+# Valores monetários (vl_*) ficam em float64: em float32 os centavos de PIBs na casa das centenas de milhões
+# se perdem, e esses valores aparecem na tabela e nos downloads
+TIPOS_PIB = {
+    'ano_pib': 'int16', 'codigo_municipio_dv': 'int32', 'cd_uf': 'int8', 'cd_regiao': 'int8',
+    'populacao_estimada': 'int32',
+    'latitude': 'float32', 'longitude': 'float32',
+    'sigla_uf': 'category', 'nome_uf': 'category', 'nome_municipio': 'category',
+}
+
+def otimizar_tipos_pib(df, categorias=True):
+    return df.astype({
+        col: tipo for col, tipo in TIPOS_PIB.items()
+        if col in df.columns and (categorias or tipo != 'category')
+    })
+
+def consolidar_tipos_pib(df):
+    # O astype por coluna deixa um bloco por coluna; a cópia profunda junta um bloco 2D contíguo por dtype,
+    # o que mantém rápidas as reduções por coluna (.sum) feitas depois
+    return otimizar_tipos_pib(df).copy()
+
+TAMANHO_BLOCO_SQL = 100_000
+
+def ler_sql_em_blocos(connection, query, params=None, converter=None):
+    # Cursor no servidor: o psycopg2 não materializa o resultado inteiro de uma vez
+    connection = connection.execution_options(stream_results=True)
+    blocos = pd.read_sql_query(sql=text(query), con=connection, params=params, chunksize=TAMANHO_BLOCO_SQL)
+    if converter is not None:
+        blocos = (converter(bloco) for bloco in blocos)
+    blocos = list(blocos)
+    return pd.concat(blocos, ignore_index=True) if blocos else pd.DataFrame()
+
+@st.cache_resource(ttl=3600)
+def obter_conn_string_cx(_engine):
+    # O ConnectorX abre conexões próprias, fora do pool: o statement_timeout vai na própria URL
+    conn_string = _engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+    separador = '&' if '?' in conn_string else '?'
+    return f"{conn_string}{separador}options={quote(OPCOES_CONEXAO)}"
+
+def renderizar_query(query, params=None):
+    # O ConnectorX não faz binding de parâmetros: os valores são adaptados pelo psycopg2 (escape seguro)
+    if not params:
+        return query
+    return re.sub(r'(?<!:):(\w+)', lambda m: adapt(params[m.group(1)]).getquoted().decode(), query)
+
+def ler_sql_connectorx(_engine, query, params=None):
+    tabela = cx.read_sql(obter_conn_string_cx(_engine), renderizar_query(query, params), return_type='arrow', protocol='binary')
+    # self_destruct só libera cada coluna Arrow ao convertê-la se o pandas não consolidar os blocos
+    # (split_blocks) e a conversão for sequencial (use_threads=False); assim a conversão não dobra o pico de memória
+    return tabela.to_pandas(self_destruct=True, split_blocks=True, use_threads=False)
+
 @st.cache_data(ttl=3600)
-def carregar_dados_db(_engine, query, params=None):
+def carregar_dados_db(_engine, query, params=None, em_blocos=False, otimizar_tipos=False):
     if _engine is None:
         return pd.DataFrame()
+    # ConnectorX só nas cargas por município (otimizar_tipos): nas agregações pequenas uma conexão nova com TLS
+    # custa mais que pegar uma do pool
+    if cx is not None and otimizar_tipos:
+        try:
+            return consolidar_tipos_pib(ler_sql_connectorx(_engine, query, params))
+        except Exception as e:
+            st.warning(f"ConnectorX indisponível, usando psycopg2: {e}")
+    try:
+        if not em_blocos:
+            df = pd.read_sql_query(sql=text(query), con=_engine, params=params)
+        else:
+            converter = (lambda bloco: otimizar_tipos_pib(bloco, categorias=False)) if otimizar_tipos else None
+            with _engine.connect() as connection:
+                df = ler_sql_em_blocos(connection, query, params=params, converter=converter)
+        return consolidar_tipos_pib(df) if otimizar_tipos else df
+    except Exception as e:
+        st.error(f"Erro ao carregar dados: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=3600)
+def carregar_metadados_db(_engine):
+    vazio = ([], pd.DataFrame(), pd.DataFrame())
+    if _engine is None:
+        return vazio
+    # Anos, UFs e municípios numa única ida ao banco: cada lista vem agregada numa coluna da mesma linha
+    expr_ano = obter_expr_ano_pib(_engine)
+    query = f"""
+    SELECT
+        (SELECT array_agg(DISTINCT {expr_ano} ORDER BY {expr_ano} DESC) FROM pib_municipios p) AS anos,
+        (SELECT json_agg(json_build_object('cd_uf', cd_uf, 'sigla_uf', sigla_uf, 'nome_uf', nome_uf) ORDER BY sigla_uf)
+           FROM unidade_federacao) AS ufs,
+        (SELECT json_agg(json_build_object('codigo_municipio_dv', codigo_municipio_dv, 'nome_municipio', nome_municipio,
+                                           'municipio_capital', municipio_capital, 'cd_uf', cd_uf) ORDER BY nome_municipio)
+           FROM municipio) AS municipios
+    """
     try:
         with _engine.connect() as connection:
-            df = pd.read_sql_query(sql=text(query), con=connection, params=params)
-        return df
+            anos, ufs, municipios = connection.execute(text(query)).one()
+    except Exception as e:
+        st.error(f"Erro ao carregar dados: {e}")
+        return vazio
+    return [int(ano) for ano in anos or []], pd.DataFrame(ufs or []), pd.DataFrame(municipios or [])
+
+VERSAO_CACHE_PIB = 4
+DIRETORIO_CACHE_PIB = os.path.dirname(os.path.abspath(__file__))
+PREFIXO_CACHE_PIB = f'pib_cache_v{VERSAO_CACHE_PIB}_'
+FORMATO_DATA_CACHE_PIB = '%Y%m%d%H%M%S'
+VALIDADE_CACHE_PIB = timedelta(days=7)
+IDADE_MAXIMA_TMP_CACHE_PIB = timedelta(hours=1)
+
+def listar_caches_pib():
+    # Só snapshots completos (os temporários terminam em .tmp), do mais novo para o mais antigo: o nome leva a data
+    nomes = [nome for nome in os.listdir(DIRETORIO_CACHE_PIB) if nome.startswith(PREFIXO_CACHE_PIB) and nome.endswith('.parquet')]
+    return [os.path.join(DIRETORIO_CACHE_PIB, nome) for nome in sorted(nomes, reverse=True)]
+
+def limpar_caches_pib_obsoletos():
+    # Snapshots de versões anteriores do formato e temporários de gerações interrompidas não são mais lidos;
+    # temporários recentes podem ser de outro processo gerando o snapshot agora
+    for nome in os.listdir(DIRETORIO_CACHE_PIB):
+        if not nome.startswith('pib_cache_v'):
+            continue
+        caminho = os.path.join(DIRETORIO_CACHE_PIB, nome)
+        try:
+            if nome.endswith('.tmp'):
+                obsoleto = datetime.now() - datetime.fromtimestamp(os.path.getmtime(caminho)) > IDADE_MAXIMA_TMP_CACHE_PIB
+            else:
+                obsoleto = not nome.startswith(PREFIXO_CACHE_PIB)
+        except OSError:
+            continue
+        if obsoleto:
+            shutil.rmtree(caminho, ignore_errors=True)
+
+def data_cache_pib(caminho):
+    return datetime.strptime(os.path.basename(caminho)[len(PREFIXO_CACHE_PIB):].split('_')[0], FORMATO_DATA_CACHE_PIB)
+
+def legenda_cache_pib(caminho):
+    return (
+        f"Dados do cache local gerado em {data_cache_pib(caminho):%d/%m/%Y %H:%M} (renovado a cada "
+        f"{VALIDADE_CACHE_PIB.days} dias); indicadores, ranking e composição setorial consultam o banco diretamente."
+    )
+
+@st.cache_resource(ttl=3600)
+def obter_cache_pib_parquet(_engine):
+    # Os dados do PIB municipal são anuais: uma cópia local em Parquet evita ida ao banco a cada filtro
+    caches = listar_caches_pib()
+    if caches and datetime.now() - data_cache_pib(caches[0]) < VALIDADE_CACHE_PIB:
+        return caches[0]
+
+    query = f"""
+    SELECT 
+        {obter_expr_ano_pib(_engine)} AS ano_pib, p.codigo_municipio_dv, p.vl_pib, p.vl_pib_per_capta,
+        p.vl_agropecuaria, p.vl_industria, p.vl_servicos, p.vl_administracao,
+        {EXPR_POPULACAO_ESTIMADA} AS populacao_estimada,
+        m.nome_municipio, m.municipio_capital, m.longitude, m.latitude, m.cd_uf,
+        u.sigla_uf, u.nome_uf, u.cd_regiao
+    FROM pib_municipios p
+    JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
+    JOIN unidade_federacao u ON m.cd_uf = u.cd_uf
+    """
+    # Cada geração ganha um nome novo (data + pid) e um temporário exclusivo: o rename nunca sobrescreve um snapshot
+    # em uso, nem processos concorrentes disputam o mesmo diretório temporário
+    caminho = os.path.join(DIRETORIO_CACHE_PIB, f"{PREFIXO_CACHE_PIB}{datetime.now():{FORMATO_DATA_CACHE_PIB}}_{os.getpid()}.parquet")
+    caminho_tmp = f"{caminho}.{uuid.uuid4().hex}.tmp"
+    try:
+        with _engine.connect() as connection:
+            # Numéricos estreitados bloco a bloco; categorias só após o concat, para que todos os blocos compartilhem o mesmo dicionário
+            df = ler_sql_em_blocos(connection, query, converter=lambda bloco: otimizar_tipos_pib(bloco, categorias=False))
+        df = otimizar_tipos_pib(df)
+        df.to_parquet(caminho_tmp, engine='pyarrow', partition_cols=['ano_pib'], index=False)
+        os.rename(caminho_tmp, caminho)
+    except Exception as e:
+        st.warning(f"Cache local indisponível, consultando o banco diretamente: {e}")
+        shutil.rmtree(caminho_tmp, ignore_errors=True)
+        return caches[0] if caches else None
+
+    # O snapshot anterior continua para quem ainda aponta para ele; só os mais antigos são removidos
+    for caminho_antigo in caches[1:]:
+        shutil.rmtree(caminho_antigo, ignore_errors=True)
+    limpar_caches_pib_obsoletos()
+    return caminho
+
+@st.cache_data(ttl=3600)
+def ler_pib_parquet(caminho, anos, municipios_codigos=None, cd_ufs=None, colunas=None):
+    # Varredura preguiçosa e multithread do Polars; filtros descem até as partições e row groups
+    filtro = pl.col('ano_pib').is_between(anos[0], anos[1])
+    if municipios_codigos is not None:
+        filtro &= pl.col('codigo_municipio_dv').is_in(list(municipios_codigos))
+    elif cd_ufs is not None:
+        filtro &= pl.col('cd_uf').is_in(list(cd_ufs))
+
+    try:
+        df = (
+            pl.scan_parquet(os.path.join(caminho, '**', '*.parquet'), hive_partitioning=True)
+            .filter(filtro)
+            .select(list(colunas or COLUNAS_DETALHE))
+            .collect()
+            .to_pandas()
+        )
     except Exception as e:
         st.error(f"Erro ao carregar dados: {e}")
         return pd.DataFrame()
+    if 'ano_pib' in df.columns:
+        df['ano_pib'] = df['ano_pib'].astype('int16')
+    return df
+
+# Mesma ordem do SELECT de consultar_dados_pib: no Parquet particionado o ano_pib iria para o fim
+COLUNAS_DETALHE = (
+    'ano_pib', 'codigo_municipio_dv', 'vl_pib', 'vl_pib_per_capta',
+    'vl_agropecuaria', 'vl_industria', 'vl_servicos', 'vl_administracao', 'populacao_estimada',
+    'nome_municipio', 'municipio_capital', 'longitude', 'latitude', 'sigla_uf', 'nome_uf', 'cd_regiao',
+)
+COLUNAS_GEO = ('nome_municipio', 'latitude', 'longitude', 'vl_pib', 'vl_pib_per_capta')
+LIMITE_PONTOS_RASTER = 1_000
+LARGURA_RASTER_MAPA = 240
+RAIO_MAXIMO_MAPA = 60_000
+COR_MAPA_INICIAL = np.array([219, 234, 254])
+COR_MAPA_FINAL = np.array([30, 58, 138])
+
+SETORES_COLS = ['vl_agropecuaria', 'vl_industria', 'vl_servicos', 'vl_administracao']
+SETORES_NOMES = ['Agropecuária', 'Indústria', 'Serviços', 'Adm. Pública']
+
+def montar_filtro_pib(anos, municipios_codigos=None, cd_ufs=None, expr_ano='p.ano_pib'):
+    clausulas = [f"{expr_ano} BETWEEN :ano_inicial AND :ano_final"]
+    params = {'ano_inicial': anos[0], 'ano_final': anos[1]}
+
+    # None indica "todos": sem predicado por município, só por UF (ou nenhum para o Brasil inteiro)
+    if municipios_codigos is not None:
+        clausulas.append("p.codigo_municipio_dv = ANY(:municipios_codigos)")
+        params['municipios_codigos'] = list(municipios_codigos)
+    elif cd_ufs is not None:
+        clausulas.append("p.codigo_municipio_dv IN (SELECT codigo_municipio_dv FROM municipio WHERE cd_uf = ANY(:cd_ufs))")
+        params['cd_ufs'] = list(cd_ufs)
+
+    return "WHERE " + "\n    AND ".join(clausulas), params
+
+def selecao_vazia(municipios_codigos, cd_ufs=None):
+    return (municipios_codigos is not None and not municipios_codigos) or (cd_ufs is not None and not cd_ufs)
+
+# Contador de escritas da tabela fato gravado na visão no último REFRESH x contador atual: duas leituras de uma linha
+CONFERENCIA_PIB_ANUAL_UF = """
+SELECT
+    (SELECT MAX(modificacoes_fato) FROM pib_anual_uf) AS modificacoes_visao,
+    (SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables
+      WHERE relid = 'pib_municipios'::regclass) AS modificacoes_fato
+"""
+
+@st.cache_data(ttl=3600)
+def pib_anual_uf_utilizavel(_engine):
+    # Se a tabela fato recebeu escritas depois do último REFRESH, as agregações voltam para ela (como ranking e
+    # composição setorial) até o job noturno atualizar a visão; o painel não executa REFRESH (ver README)
+    try:
+        with _engine.connect() as connection:
+            if not connection.execute(text("SELECT to_regclass('pib_anual_uf') IS NOT NULL")).scalar():
+                return False
+            modificacoes_visao, modificacoes_fato = connection.execute(text(CONFERENCIA_PIB_ANUAL_UF)).one()
+    except Exception:
+        return False
+    return modificacoes_visao is not None and modificacoes_visao == modificacoes_fato
+
+@st.cache_data(ttl=3600)
+def obter_pib_nacional(_engine, anos, cd_ufs=None):
+    # Lê a visão materializada pib_anual_uf (migrations/002): poucas linhas por ano em vez da tabela fato
+    clausulas = ["ano_pib BETWEEN :ano_inicial AND :ano_final"]
+    params = {'ano_inicial': anos[0], 'ano_final': anos[1]}
+    if cd_ufs is not None:
+        clausulas.append("cd_uf = ANY(:cd_ufs)")
+        params['cd_ufs'] = list(cd_ufs)
+
+    query = f"""
+    SELECT
+        ano_pib,
+        SUM(vl_pib) AS vl_pib,
+        SUM(soma_pib_per_capta) / NULLIF(SUM(qtd_pib_per_capta), 0) AS vl_pib_per_capta,
+        SUM(populacao_estimada) AS populacao_estimada,
+        SUM(vl_pib) / NULLIF(SUM(populacao_estimada), 0) AS pib_per_capita_ponderado,
+        SUM(num_municipios) AS num_municipios,
+        SUM(vl_agropecuaria) AS vl_agropecuaria,
+        SUM(vl_industria) AS vl_industria,
+        SUM(vl_servicos) AS vl_servicos,
+        SUM(vl_administracao) AS vl_administracao
+    FROM pib_anual_uf
+    WHERE {" AND ".join(clausulas)}
+    GROUP BY 1
+    ORDER BY 1
+    """
+    return carregar_dados_db(_engine, query, params=params)
+
+@st.cache_data(ttl=3600)
+def agregar_por_ano(_engine, anos, municipios_codigos=None, cd_ufs=None):
+    if not anos or selecao_vazia(municipios_codigos, cd_ufs):
+        return pd.DataFrame()
+
+    # Sem municípios específicos a visão materializada já tem as somas por UF e ano
+    if municipios_codigos is None and pib_anual_uf_utilizavel(_engine):
+        df_totais = obter_pib_nacional(_engine, anos, cd_ufs)
+        return df_totais.set_index('ano_pib') if not df_totais.empty else df_totais
+
+    expr_ano = obter_expr_ano_pib(_engine)
+    filtro, params = montar_filtro_pib(anos, municipios_codigos, cd_ufs, expr_ano)
+    query = f"""
+    SELECT
+        {expr_ano} AS ano_pib,
+        SUM(p.vl_pib) AS vl_pib,
+        AVG(p.vl_pib_per_capta) AS vl_pib_per_capta,
+        SUM({EXPR_POPULACAO_ESTIMADA}) AS populacao_estimada,
+        SUM(p.vl_pib) / NULLIF(SUM({EXPR_POPULACAO_ESTIMADA}), 0) AS pib_per_capita_ponderado,
+        COUNT(DISTINCT p.codigo_municipio_dv) AS num_municipios,
+        SUM(p.vl_agropecuaria) AS vl_agropecuaria,
+        SUM(p.vl_industria) AS vl_industria,
+        SUM(p.vl_servicos) AS vl_servicos,
+        SUM(p.vl_administracao) AS vl_administracao
+    FROM pib_municipios p
+    {filtro}
+    GROUP BY 1
+    ORDER BY 1
+    """
+    df_totais = carregar_dados_db(_engine, query, params=params)
+    # Indexado por ano uma única vez (em cache): KPIs e evolução consultam por .loc, sem filtros por máscara
+    return df_totais.set_index('ano_pib') if not df_totais.empty else df_totais
+
+@st.cache_data(ttl=3600)
+def agregar_por_uf(_engine, ano, municipios_codigos=None, cd_ufs=None):
+    if selecao_vazia(municipios_codigos, cd_ufs):
+        return pd.DataFrame(), pd.DataFrame()
+
+    filtro, params = montar_filtro_pib((ano, ano), municipios_codigos, cd_ufs, obter_expr_ano_pib(_engine))
+    query = f"""
+    SELECT
+        u.sigla_uf,
+        SUM(p.vl_agropecuaria) AS vl_agropecuaria,
+        SUM(p.vl_industria) AS vl_industria,
+        SUM(p.vl_servicos) AS vl_servicos,
+        SUM(p.vl_administracao) AS vl_administracao
+    FROM pib_municipios p
+    JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
+    JOIN unidade_federacao u ON m.cd_uf = u.cd_uf
+    {filtro}
+    GROUP BY u.sigla_uf
+    ORDER BY u.sigla_uf
+    """
+    df_uf = carregar_dados_db(_engine, query, params=params)
+    if df_uf.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    totais = df_uf[SETORES_COLS].sum()
+    df_pizza = totais.rename(dict(zip(SETORES_COLS, SETORES_NOMES))).rename_axis('Setor').reset_index(name='Valor')
+    df_bar_melted = (
+        df_uf.astype({'sigla_uf': 'category'})
+        .set_index('sigla_uf')[SETORES_COLS]
+        .rename(columns=dict(zip(SETORES_COLS, SETORES_NOMES)))
+        .rename_axis(columns='setor')
+        .stack()
+        .reset_index(name='valor')
+    )
+    return df_pizza, df_bar_melted
+
+@st.cache_data(ttl=3600)
+def selecionar_ranking(_engine, ano, municipios_codigos, cd_ufs, valor_col, n, ascendente=False):
+    if selecao_vazia(municipios_codigos, cd_ufs) or valor_col not in ('vl_pib', 'vl_pib_per_capta'):
+        return pd.DataFrame()
+
+    filtro, params = montar_filtro_pib((ano, ano), municipios_codigos, cd_ufs, obter_expr_ano_pib(_engine))
+    ordem = "ASC" if ascendente else "DESC"
+    query = f"""
+    SELECT
+        p.codigo_municipio_dv, p.vl_pib, p.vl_pib_per_capta,
+        m.nome_municipio, m.municipio_capital, u.sigla_uf
+    FROM pib_municipios p
+    JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
+    JOIN unidade_federacao u ON m.cd_uf = u.cd_uf
+    {filtro}
+    ORDER BY p.{valor_col} {ordem} NULLS LAST
+    LIMIT :n
+    """
+    return carregar_dados_db(_engine, query, params={**params, 'n': n})
+
+def chave_dataframe(df):
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+def taxa_crescimento(valores):
+    # Variação percentual ano a ano sobre o array já ordenado; o primeiro ano fica NaN
+    valores = np.asarray(valores, dtype='float64')
+    crescimento = np.full_like(valores, np.nan)
+    anteriores = valores[:-1]
+    np.divide((valores[1:] - anteriores) * 100, anteriores, out=crescimento[1:], where=anteriores != 0)
+    return crescimento
+
+# Figuras em cache como JSON (picklável); o argumento _df não é hasheado, a chave é o digest do frame
+@st.cache_data(max_entries=32)
+def construir_figuras_evolucao(_df_evolucao, chave, tipo_vis):
+    fig_area = px.area(_df_evolucao, x='ano_pib', y='valor', title=f'Evolução do {tipo_vis}', markers=True)
+    fig_area.update_layout(height=400, hovermode='x unified')
+
+    fig_barra_json = None
+    if len(_df_evolucao) > 1:
+        df_crescimento = _df_evolucao.assign(**{'crescimento_%': taxa_crescimento(_df_evolucao['valor'].to_numpy())})
+        fig_barra = px.bar(df_crescimento.dropna(), x='ano_pib', y='crescimento_%', title='Taxa de Crescimento Anual (%)')
+        fig_barra.update_layout(height=300)
+        fig_barra_json = fig_barra.to_json()
+    return fig_area.to_json(), fig_barra_json
+
+@st.cache_data(max_entries=32)
+def construir_figura_ranking(_df_ranking, chave, valor_col, titulo, n, ascendente=False):
+    fig = px.bar(_df_ranking, x=valor_col, y='display_name', orientation='h', title=titulo, color='sigla_uf')
+    if ascendente:
+        fig.update_layout(yaxis_categoryorder='total descending', height=max(400, n * 35))
+    else:
+        fig.update_layout(yaxis_categoryorder='total ascending', height=max(400, n * 35), legend_title_text='UF')
+    return fig.to_json()
+
+@st.cache_data(max_entries=32)
+def construir_figuras_setoriais(_df_pizza, _df_bar_melted, chave):
+    fig_pizza = px.pie(_df_pizza, values='Valor', names='Setor', title='Distribuição Setorial Agregada', hole=0.4)
+    fig_pizza.update_traces(textposition='inside', textinfo='percent+label')
+    fig_bar = px.bar(_df_bar_melted, x='sigla_uf', y='valor', color='setor', title='Composição do PIB por UF', barmode='stack')
+    return fig_pizza.to_json(), fig_bar.to_json()
+
+def rasterizar_pontos(df_geo, valor_col):
+    # Agrega o valor em uma grade de pixels (projeção Web Mercator) e devolve um PNG: O(pixels), não O(pontos)
+    lon = df_geo['longitude'].to_numpy(dtype='float64')
+    y = np.log(np.tan(np.pi / 4 + np.radians(df_geo['latitude'].to_numpy(dtype='float64')) / 2))
+    pesos = np.clip(df_geo[valor_col].to_numpy(dtype='float64'), 0, None)
+
+    lon_min, lon_max = lon.min(), lon.max()
+    y_min, y_max = y.min(), y.max()
+    altura = max(1, int(round(LARGURA_RASTER_MAPA * (y_max - y_min) / max(np.radians(lon_max - lon_min), 1e-9))))
+    faixas = dict(bins=(altura, LARGURA_RASTER_MAPA), range=[[y_min, y_max], [lon_min, lon_max]])
+    grade, _, _ = np.histogram2d(y, lon, weights=pesos, **faixas)
+    contagem, _, _ = np.histogram2d(y, lon, **faixas)
+    if valor_col == 'vl_pib_per_capta':
+        # Per capita não se soma: o pixel mostra a média dos municípios que caem nele; o PIB total continua somado
+        grade = np.divide(grade, contagem, out=np.zeros_like(grade), where=contagem > 0)
+    grade, contagem = np.flipud(grade), np.flipud(contagem)
+
+    intensidade = np.log1p(grade) / max(np.log1p(grade.max()), 1e-9)
+    rgba = np.zeros(grade.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = np.rint(COR_MAPA_INICIAL + (COR_MAPA_FINAL - COR_MAPA_INICIAL) * intensidade[..., None])
+    rgba[..., 3] = np.where(contagem > 0, 220, 0)
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+    imagem = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+    lat_min, lat_max = np.degrees(2 * np.arctan(np.exp([y_min, y_max])) - np.pi / 2)
+    return imagem, [float(lon_min), float(lat_min), float(lon_max), float(lat_max)]
+
+@st.cache_resource(max_entries=32)
+def construir_mapa(_df_geo, chave, valor_col):
+    if len(_df_geo) > LIMITE_PONTOS_RASTER:
+        imagem, limites = rasterizar_pontos(_df_geo, valor_col)
+        camada = pdk.Layer('BitmapLayer', data=None, image=imagem, bounds=limites, opacity=0.9)
+        tooltip = False
+    else:
+        valores = _df_geo[valor_col].to_numpy(dtype='float64')
+        escala = valores.max() if valores.max() > 0 else 1.0
+        intensidade = np.sqrt(np.clip(valores, 0, None) / escala)
+        cores = COR_MAPA_INICIAL + (COR_MAPA_FINAL - COR_MAPA_INICIAL) * intensidade[:, None]
+        df_mapa = pd.DataFrame({
+            'nome_municipio': _df_geo['nome_municipio'].astype(str).to_numpy(),
+            'longitude': _df_geo['longitude'].to_numpy(),
+            'latitude': _df_geo['latitude'].to_numpy(),
+            'valor': np.round(valores, 2),
+            'raio': intensidade * RAIO_MAXIMO_MAPA,
+            'cor': np.column_stack([np.rint(cores).astype(int), np.full(len(cores), 200)]).tolist(),
+        })
+        camada = pdk.Layer(
+            'ScatterplotLayer', df_mapa, get_position=['longitude', 'latitude'], get_radius='raio',
+            get_fill_color='cor', radius_min_pixels=2, pickable=True
+        )
+        tooltip = {'html': '<b>{nome_municipio}</b><br/>{valor}'}
+
+    vista = pdk.ViewState(
+        latitude=float(_df_geo['latitude'].mean()), longitude=float(_df_geo['longitude'].mean()), zoom=3.5
+    )
+    return pdk.Deck(layers=[camada], initial_view_state=vista, map_style='light', tooltip=tooltip)
+
+# Formatação feita pelo próprio grid do st.dataframe, sem montar um Styler nem copiar o DataFrame
+CONFIG_COLUNAS_TABELA = {
+    'ano_pib': st.column_config.NumberColumn('Ano', format="%d"),
+    'vl_pib': st.column_config.NumberColumn('PIB', format="R$ %.2f"),
+    'vl_pib_per_capta': st.column_config.NumberColumn('PIB per capita', format="R$ %.2f"),
+    'vl_agropecuaria': st.column_config.NumberColumn('Agropecuária', format="R$ %.2f"),
+    'vl_industria': st.column_config.NumberColumn('Indústria', format="R$ %.2f"),
+    'vl_servicos': st.column_config.NumberColumn('Serviços', format="R$ %.2f"),
+    'vl_administracao': st.column_config.NumberColumn('Adm. Pública', format="R$ %.2f"),
+    'populacao_estimada': st.column_config.NumberColumn('População estimada', format="%d"),
+}
+
+@st.cache_data(max_entries=8)
+def exportar_tabela(_df, chave):
+    tabela = pa.Table.from_pandas(_df, preserve_index=False)
+    buffer_csv = io.BytesIO()
+    pa_csv.write_csv(tabela, buffer_csv)
+    buffer_parquet = io.BytesIO()
+    pq.write_table(tabela, buffer_parquet, compression='zstd')
+    return buffer_csv.getvalue(), buffer_parquet.getvalue()
 
 class DashboardPIB:
     def __init__(self):
@@ -124,62 +665,74 @@ class DashboardPIB:
 
     def inicializar_estado(self):
         with st.spinner("Carregando dados iniciais..."):
-            st.session_state.anos_disponiveis = self.obter_anos_disponiveis()
-            st.session_state.ufs_df = self.obter_ufs_disponiveis()
+            (
+                st.session_state.anos_disponiveis,
+                st.session_state.ufs_df,
+                st.session_state.municipios_df,
+            ) = self.obter_metadados()
             st.session_state.initialized = True
             
-    def obter_anos_disponiveis(self):
-        query = "SELECT DISTINCT ano_pib FROM pib_municipios ORDER BY ano_pib DESC"
-        df = carregar_dados_db(self.engine, query)
-        return [int(ano) for ano in df['ano_pib']] if not df.empty else []
-
-    def obter_ufs_disponiveis(self):
-        query = "SELECT cd_uf, sigla_uf, nome_uf FROM unidade_federacao ORDER BY sigla_uf"
-        return carregar_dados_db(self.engine, query)
+    def obter_metadados(self):
+        anos, ufs_df, municipios_df = carregar_metadados_db(self.engine)
+        if not municipios_df.empty:
+            # 27 UFs: o isin sobre os códigos da categoria evita hash de cada valor a cada interação
+            municipios_df = municipios_df.astype({'cd_uf': 'category'})
+        return anos, ufs_df, municipios_df
     
     def obter_municipios_por_ufs(self, ufs_selecionadas_siglas):
         if not ufs_selecionadas_siglas:
             return pd.DataFrame(columns=['codigo_municipio_dv', 'nome_municipio'])
             
         ufs_df = st.session_state.ufs_df
-        cd_ufs = ufs_df[ufs_df['sigla_uf'].isin(ufs_selecionadas_siglas)]['cd_uf'].tolist()
+        cd_ufs = ufs_df[ufs_df['sigla_uf'].isin(ufs_selecionadas_siglas)]['cd_uf']
         
-        query = """
-        SELECT codigo_municipio_dv, nome_municipio, municipio_capital
-        FROM municipio 
-        WHERE cd_uf IN :cd_ufs
-        ORDER BY nome_municipio
-        """
-        return carregar_dados_db(self.engine, query, params={'cd_ufs': tuple(cd_ufs)})
+        municipios_df = st.session_state.municipios_df
+        return municipios_df[municipios_df['cd_uf'].isin(cd_ufs)]
 
-    def obter_dados_pib_filtrados(self, anos, municipios_codigos):
-        if not municipios_codigos or not anos:
+    def obter_dados_pib_filtrados(self, anos, municipios_codigos=None, cd_ufs=None):
+        if not anos or selecao_vazia(municipios_codigos, cd_ufs):
             return pd.DataFrame()
         
-        query = """
+        caminho_cache = obter_cache_pib_parquet(self.engine)
+        if caminho_cache is not None:
+            st.caption(legenda_cache_pib(caminho_cache))
+            return ler_pib_parquet(caminho_cache, anos, municipios_codigos, cd_ufs)
+        return self.consultar_dados_pib(anos, municipios_codigos, cd_ufs)
+
+    def obter_dados_geo(self, ano, municipios_codigos=None, cd_ufs=None):
+        if selecao_vazia(municipios_codigos, cd_ufs):
+            return pd.DataFrame()
+
+        caminho_cache = obter_cache_pib_parquet(self.engine)
+        if caminho_cache is not None:
+            st.caption(legenda_cache_pib(caminho_cache))
+            return ler_pib_parquet(caminho_cache, (ano, ano), municipios_codigos, cd_ufs, colunas=COLUNAS_GEO)
+
+        filtro, params = montar_filtro_pib((ano, ano), municipios_codigos, cd_ufs, obter_expr_ano_pib(self.engine))
+        query = f"""
+        SELECT m.nome_municipio, m.latitude, m.longitude, p.vl_pib, p.vl_pib_per_capta
+        FROM pib_municipios p
+        JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
+        {filtro}
+        """
+        return carregar_dados_db(self.engine, query, params=params, otimizar_tipos=True)
+
+    def consultar_dados_pib(self, anos, municipios_codigos=None, cd_ufs=None):
+        expr_ano = obter_expr_ano_pib(self.engine)
+        filtro, params = montar_filtro_pib(anos, municipios_codigos, cd_ufs, expr_ano)
+        query = f"""
         SELECT 
-            p.ano_pib, p.codigo_municipio_dv, p.vl_pib, p.vl_pib_per_capta,
+            {expr_ano} AS ano_pib, p.codigo_municipio_dv, p.vl_pib, p.vl_pib_per_capta,
             p.vl_agropecuaria, p.vl_industria, p.vl_servicos, p.vl_administracao,
+            {EXPR_POPULACAO_ESTIMADA} AS populacao_estimada,
             m.nome_municipio, m.municipio_capital, m.longitude, m.latitude,
             u.sigla_uf, u.nome_uf, u.cd_regiao
         FROM pib_municipios p
         JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
         JOIN unidade_federacao u ON m.cd_uf = u.cd_uf
-        WHERE CAST(p.ano_pib AS INTEGER) BETWEEN :ano_inicial AND :ano_final
-        AND p.codigo_municipio_dv IN :municipios_codigos
+        {filtro}
         """
-        params = {
-            'ano_inicial': anos[0], 
-            'ano_final': anos[1], 
-            'municipios_codigos': tuple(municipios_codigos)
-        }
-        df = carregar_dados_db(self.engine, query, params=params)
-        
-        if not df.empty and 'populacao_estimada' not in df.columns:
-            df['populacao_estimada'] = (df['vl_pib'] / df['vl_pib_per_capta']).fillna(0).astype(int)
-        
-        gc.collect()
-        return df
+        return carregar_dados_db(self.engine, query, params=params, em_blocos=True, otimizar_tipos=True)
 
     def exibir_barra_lateral(self):
         st.sidebar.markdown("<h2 style='text-align: center; color: #1E3A8A;'>Filtros</h2><hr>", unsafe_allow_html=True)
@@ -203,25 +756,40 @@ class DashboardPIB:
             help="Selecione 'TODAS' para analisar o Brasil inteiro."
         )
 
-        if "TODAS" in selecao_filtro_uf or not selecao_filtro_uf:
+        todas_ufs = "TODAS" in selecao_filtro_uf or not selecao_filtro_uf
+        if todas_ufs:
             st.session_state.ufs_selecionadas = ufs_disponiveis
         else:
             st.session_state.ufs_selecionadas = selecao_filtro_uf
         
-        municipios_df = self.obter_municipios_por_ufs(st.session_state.ufs_selecionadas)
-        municipios_disponiveis = sorted(municipios_df['nome_municipio'].unique())
+        # Calculado uma vez por conjunto de UFs: lista de opções e mapa nome -> códigos para resolver a seleção
+        # por dicionário. A tabela já vem ordenada por nome e há nomes repetidos entre UFs, daí a lista de códigos
+        municipios_por_ufs = st.session_state.setdefault('municipios_por_ufs', {})
+        chave_ufs = frozenset(st.session_state.ufs_selecionadas)
+        if chave_ufs not in municipios_por_ufs:
+            municipios_df = self.obter_municipios_por_ufs(st.session_state.ufs_selecionadas)
+            codigos_por_nome = {}
+            for nome, codigo in zip(municipios_df['nome_municipio'].tolist(), municipios_df['codigo_municipio_dv'].tolist()):
+                codigos_por_nome.setdefault(nome, []).append(codigo)
+            municipios_por_ufs[chave_ufs] = (list(codigos_por_nome), codigos_por_nome, tuple(municipios_df['codigo_municipio_dv'].tolist()))
+        municipios_disponiveis, codigos_por_nome, todos_codigos = municipios_por_ufs[chave_ufs]
 
         st.session_state.municipios_selecionados_nomes = st.sidebar.multiselect(
             "Município(s)", options=municipios_disponiveis, default=[],
             help="Deixe em branco para analisar todos do(s) estado(s) selecionado(s)."
         )
 
-        if not st.session_state.municipios_selecionados_nomes:
-            st.session_state.codigos_municipios_selecionados = municipios_df['codigo_municipio_dv'].tolist()
+        st.session_state.todos_municipios = not st.session_state.municipios_selecionados_nomes
+        if st.session_state.todos_municipios:
+            st.session_state.codigos_municipios_selecionados = todos_codigos
         else:
-            st.session_state.codigos_municipios_selecionados = municipios_df[
-                municipios_df['nome_municipio'].isin(st.session_state.municipios_selecionados_nomes)
-            ]['codigo_municipio_dv'].tolist()
+            st.session_state.codigos_municipios_selecionados = tuple(
+                codigo for nome in st.session_state.municipios_selecionados_nomes for codigo in codigos_por_nome[nome]
+            )
+
+        cd_ufs = None if todas_ufs else tuple(ufs_df[ufs_df['sigla_uf'].isin(st.session_state.ufs_selecionadas)]['cd_uf'].tolist())
+        codigos = None if st.session_state.todos_municipios else st.session_state.codigos_municipios_selecionados
+        st.session_state.filtro_selecao = (codigos, cd_ufs)
         
         st.session_state.tipo_visualizacao = st.sidebar.radio(
             "Visualizar por", ["PIB Total", "PIB Per Capita"], horizontal=True
@@ -231,35 +799,35 @@ class DashboardPIB:
             st.session_state.num_ranking = st.slider("Nº de Municípios no Ranking", 5, 30, 10)
             st.session_state.destacar_capitais = st.checkbox("Destacar Capitais 🏛️", True)
 
-    def exibir_kpis(self, df):
+    def exibir_kpis(self, df_totais):
         st.markdown("<h2 class='sub-header'>Indicadores Chave</h2>", unsafe_allow_html=True)
 
-        if df.empty:
+        if df_totais.empty:
             st.info("Não há dados para os filtros selecionados.")
             return
 
-        df['ano_pib'] = pd.to_numeric(df['ano_pib'])
         ano_inicial, ano_final = st.session_state.anos_selecionados
-        df_ano_final = df[df['ano_pib'] == ano_final]
-        df_ano_inicial = df[df['ano_pib'] == ano_inicial]
 
-        if df_ano_final.empty:
+        if ano_final not in df_totais.index:
             st.warning(f"Não há dados para o ano final ({ano_final}).")
             return
             
-        pib_total_final = df_ano_final['vl_pib'].sum()
-        pib_total_inicial = df_ano_inicial['vl_pib'].sum()
+        totais_final = df_totais.loc[ano_final]
+        pib_total_final = totais_final['vl_pib']
+        pib_total_inicial = df_totais.loc[ano_inicial, 'vl_pib'] if ano_inicial in df_totais.index else 0
         delta_pib = None
         if ano_final != ano_inicial and pib_total_inicial > 0:
             delta_pib = f"{((pib_total_final - pib_total_inicial) / pib_total_inicial) * 100:.2f}%"
 
-        pop_final = df_ano_final['populacao_estimada'].sum()
-        pib_per_capita_medio = (pib_total_final / pop_final) if pop_final > 0 else 0
-        num_municipios = df_ano_final['codigo_municipio_dv'].nunique()
+        # Média ponderada pela população já vem calculada no GROUP BY
+        pib_per_capita_medio = totais_final['pib_per_capita_ponderado']
+        if pd.isna(pib_per_capita_medio):
+            pib_per_capita_medio = 0
+        num_municipios = int(totais_final['num_municipios'])
 
-        setores = {'Agropecuária': 'vl_agropecuaria', 'Indústria': 'vl_industria', 'Serviços': 'vl_servicos'}
-        soma_setores = {nome: df_ano_final[col].sum() for nome, col in setores.items()}
-        maior_setor = max(soma_setores, key=soma_setores.get) if soma_setores else "N/A"
+        # Agropecuária, Indústria e Serviços (a administração pública fica fora da comparação)
+        valores_setores = np.nan_to_num(totais_final[SETORES_COLS[:3]].to_numpy(dtype='float64'))
+        maior_setor = SETORES_NOMES[int(valores_setores.argmax())]
 
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("PIB Total", f"R$ {pib_total_final/1e9:.2f} bi", delta=delta_pib, help=f"Variação de {ano_inicial} para {ano_final}")
@@ -267,117 +835,102 @@ class DashboardPIB:
         col3.metric("Municípios Analisados", f"{num_municipios}", help="Total de municípios na seleção para o último ano.")
         col4.metric("Setor Principal", maior_setor, help=f"Setor com maior contribuição em {ano_final}")
 
-    def exibir_graficos(self, df):
+    def exibir_graficos(self, df_totais):
         st.markdown("<h2 class='sub-header'>Visualizações Interativas</h2>", unsafe_allow_html=True)
-        tab_titles = ["Evolução Temporal 📈", "Ranking de Municípios 🏆", "Composição Setorial 📊", "Análise Geográfica 🗺️", "Dados 📄"]
-        tabs = st.tabs(tab_titles)
+        anos = st.session_state.anos_selecionados
+        filtro = st.session_state.filtro_selecao
+
+        # st.tabs executa o conteúdo de todas as abas a cada rerun; com a navegação por rádio só a aba
+        # escolhida consulta dados e monta figuras (o mapa, a mais cara, só quando aberto)
+        abas = {
+            "Evolução Temporal 📈": lambda: self.renderizar_evolucao_temporal(df_totais),
+            "Ranking de Municípios 🏆": lambda: self.renderizar_ranking_municipios(anos[1], filtro),
+            "Composição Setorial 📊": lambda: self.renderizar_composicao_setorial(*agregar_por_uf(self.engine, anos[1], *filtro)),
+            "Análise Geográfica 🗺️": lambda: self.renderizar_analise_geografica(self.obter_dados_geo(anos[1], *filtro)),
+            # Só a aba de dados precisa de todas as colunas por município e ano
+            "Dados 📄": lambda: self.exibir_tabela_dados(self.obter_dados_pib_filtrados(anos, *filtro)),
+        }
+        aba_ativa = st.radio("Visualização", list(abas), horizontal=True, key='aba_ativa', label_visibility="collapsed")
+        abas[aba_ativa]()
 
-        df['ano_pib'] = pd.to_numeric(df['ano_pib'])
-        ano_final = st.session_state.anos_selecionados[1]
-        df_ano_final = df[df['ano_pib'] == ano_final].copy()
-        
-        with tabs[0]:
-            self.renderizar_evolucao_temporal(df)
-        with tabs[1]:
-            self.renderizar_ranking_municipios(df_ano_final)
-        with tabs[2]:
-            self.renderizar_composicao_setorial(df_ano_final)
-        with tabs[3]:
-            self.renderizar_analise_geografica(df_ano_final)
-        with tabs[4]:
-            self.exibir_tabela_dados(df)
-
-    def renderizar_evolucao_temporal(self, df):
-        if df.empty: return
+    def renderizar_evolucao_temporal(self, df_totais):
+        if df_totais.empty: return
             
         tipo_vis = st.session_state.tipo_visualizacao
         y_col = 'vl_pib' if tipo_vis == "PIB Total" else 'vl_pib_per_capta'
-        agg_func = 'sum' if tipo_vis == "PIB Total" else 'mean'
-        df_evolucao = df.groupby('ano_pib', as_index=False).agg(valor=(y_col, agg_func))
+        df_evolucao = df_totais[y_col].rename('valor').reset_index()
 
-        fig_area = px.area(df_evolucao, x='ano_pib', y='valor', title=f'Evolução do {tipo_vis}', markers=True)
-        fig_area.update_layout(height=400, hovermode='x unified')
-        st.plotly_chart(fig_area, use_container_width=True)
-        
-        if len(df_evolucao) > 1:
-            df_evolucao['crescimento_%'] = df_evolucao['valor'].pct_change() * 100
-            fig_barra = px.bar(df_evolucao.dropna(), x='ano_pib', y='crescimento_%', title='Taxa de Crescimento Anual (%)')
-            fig_barra.update_layout(height=300)
-            st.plotly_chart(fig_barra, use_container_width=True)
+        fig_area_json, fig_barra_json = construir_figuras_evolucao(df_evolucao, chave_dataframe(df_evolucao), tipo_vis)
+        st.plotly_chart(pio.from_json(fig_area_json), use_container_width=True)
+        if fig_barra_json is not None:
+            st.plotly_chart(pio.from_json(fig_barra_json), use_container_width=True)
         
-    def renderizar_ranking_municipios(self, df):
-        if df.empty: return
+    def _nome_exibicao(self, df):
+        destacar = df['municipio_capital'].to_numpy(dtype=bool) & st.session_state.destacar_capitais
+        return df['nome_municipio'].astype(str) + np.where(destacar, ' 🏛️', '')
 
+    def renderizar_ranking_municipios(self, ano, filtro):
         tipo_vis = st.session_state.tipo_visualizacao
         valor_col = 'vl_pib' if tipo_vis == "PIB Total" else 'vl_pib_per_capta'
         n = st.session_state.num_ranking
         
-        df['display_name'] = df.apply(
-            lambda row: f"{row['nome_municipio']} {'🏛️' if row['municipio_capital'] and st.session_state.destacar_capitais else ''}", axis=1
-        )
-        
-        top_n = df.sort_values(valor_col, ascending=False).head(n)
-        fig_top = px.bar(top_n, x=valor_col, y='display_name', orientation='h', title=f'Top {n} Municípios por {tipo_vis}', color='sigla_uf')
-        fig_top.update_layout(yaxis_categoryorder='total ascending', height=max(400, n * 35), legend_title_text='UF')
-        st.plotly_chart(fig_top, use_container_width=True)
+        top_n = selecionar_ranking(self.engine, ano, *filtro, valor_col, n)
+        if top_n.empty: return
+
+        top_n['display_name'] = self._nome_exibicao(top_n)
+        fig_top_json = construir_figura_ranking(top_n, chave_dataframe(top_n), valor_col, f'Top {n} Municípios por {tipo_vis}', n, ascendente=False)
+        st.plotly_chart(pio.from_json(fig_top_json), use_container_width=True)
 
         if st.checkbox("Mostrar municípios com menor PIB"):
-            bottom_n = df.sort_values(valor_col, ascending=True).head(n)
-            fig_bottom = px.bar(bottom_n, x=valor_col, y='display_name', orientation='h', title=f'Bottom {n} Municípios por {tipo_vis}', color='sigla_uf')
-            fig_bottom.update_layout(yaxis_categoryorder='total descending', height=max(400, n * 35))
-            st.plotly_chart(fig_bottom, use_container_width=True)
+            bottom_n = selecionar_ranking(self.engine, ano, *filtro, valor_col, n, ascendente=True)
+            if bottom_n.empty: return
 
-    def renderizar_composicao_setorial(self, df):
-        if df.empty: return
-        
-        setores_cols = ['vl_agropecuaria', 'vl_industria', 'vl_servicos', 'vl_administracao']
-        setores_nomes = ['Agropecuária', 'Indústria', 'Serviços', 'Adm. Pública']
-        total_setorial = {nome: df[col].sum() for nome, col in zip(setores_nomes, setores_cols)}
+            bottom_n['display_name'] = self._nome_exibicao(bottom_n)
+            fig_bottom_json = construir_figura_ranking(bottom_n, chave_dataframe(bottom_n), valor_col, f'Bottom {n} Municípios por {tipo_vis}', n, ascendente=True)
+            st.plotly_chart(pio.from_json(fig_bottom_json), use_container_width=True)
+
+    def renderizar_composicao_setorial(self, df_pizza, df_bar_melted):
+        if df_pizza.empty: return
         
+        fig_pizza_json, fig_bar_json = construir_figuras_setoriais(df_pizza, df_bar_melted, chave_dataframe(df_bar_melted))
         col1, col2 = st.columns([1, 1])
         with col1:
-            df_pizza = pd.DataFrame(list(total_setorial.items()), columns=['Setor', 'Valor'])
-            fig_pizza = px.pie(df_pizza, values='Valor', names='Setor', title='Distribuição Setorial Agregada', hole=0.4)
-            fig_pizza.update_traces(textposition='inside', textinfo='percent+label')
-            st.plotly_chart(fig_pizza, use_container_width=True)
-        
+            st.plotly_chart(pio.from_json(fig_pizza_json), use_container_width=True)
         with col2:
-            df_bar_uf = df.groupby('sigla_uf')[setores_cols].sum().reset_index()
-            df_bar_melted = df_bar_uf.melt(id_vars='sigla_uf', value_vars=setores_cols, var_name='setor', value_name='valor')
-            df_bar_melted['setor'] = df_bar_melted['setor'].map(dict(zip(setores_cols, setores_nomes)))
-            fig_bar = px.bar(df_bar_melted, x='sigla_uf', y='valor', color='setor', title='Composição do PIB por UF', barmode='stack')
-            st.plotly_chart(fig_bar, use_container_width=True)
+            st.plotly_chart(pio.from_json(fig_bar_json), use_container_width=True)
 
     def renderizar_analise_geografica(self, df):
         if df.empty: return
         tipo_vis = st.session_state.tipo_visualizacao
         valor_col = 'vl_pib' if tipo_vis == "PIB Total" else 'vl_pib_per_capta'
         
-        df_geo = df.dropna(subset=['latitude', 'longitude'])
-        if not df_geo.empty:
-            fig_map = px.scatter_mapbox(df_geo, lat='latitude', lon='longitude', color=valor_col, size=valor_col,
-                hover_name='nome_municipio', size_max=40, zoom=3.5, height=600, title=f'Distribuição Geográfica do {tipo_vis}',
-                color_continuous_scale=px.colors.cyclical.IceFire)
-            
-            # Remove a legenda de cor (colorbar)
-            fig_map.update_layout(
-                mapbox_style="open-street-map",
-                margin={"r":0, "t":40, "l":0, "b":0},
-                coloraxis_showscale=False 
-            )
-            st.plotly_chart(fig_map, use_container_width=True)
+        df_geo = df.dropna(subset=['latitude', 'longitude', valor_col])
+        if df_geo.empty: return
+
+        st.markdown(f"#### Distribuição Geográfica do {tipo_vis}")
+        st.pydeck_chart(construir_mapa(df_geo, chave_dataframe(df_geo), valor_col), use_container_width=True)
         
     def exibir_tabela_dados(self, df):
         st.markdown("### Dados Detalhados")
-        st.dataframe(df, use_container_width=True)
-        
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
+        st.dataframe(df, use_container_width=True, column_config=CONFIG_COLUNAS_TABELA)
+
+        # Os arquivos só são regerados quando o conteúdo da seleção muda
+        bytes_csv, bytes_parquet = exportar_tabela(df, chave_dataframe(df))
+        sufixo_arquivo = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+        col1, col2 = st.columns(2)
+        col1.download_button(
             label="📥 Download (CSV)",
-            data=csv,
-            file_name=f"pib_municipios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+            data=bytes_csv,
+            file_name=f"pib_municipios_{sufixo_arquivo}.csv",
             mime="text/csv",
         )
+        col2.download_button(
+            label="📥 Download (Parquet)",
+            data=bytes_parquet,
+            file_name=f"pib_municipios_{sufixo_arquivo}.parquet",
+            mime="application/vnd.apache.parquet",
+        )
 
     def executar(self):
         st.markdown("<h1 class='main-header'>📊 Dashboard do PIB dos Municípios Brasileiros</h1>", unsafe_allow_html=True)
@@ -389,9 +942,10 @@ class DashboardPIB:
             return # Usa return para parar a execução de forma limpa
             
         with st.spinner("Carregando e processando dados..."):
-            df_filtrado = self.obter_dados_pib_filtrados(
+            df_totais = agregar_por_ano(
+                self.engine,
                 st.session_state.anos_selecionados, 
-                st.session_state.codigos_municipios_selecionados
+                *st.session_state.filtro_selecao
             )
         
         uf_display = "TODAS" if len(st.session_state.ufs_selecionadas) >= len(st.session_state.ufs_df) else ', '.join(st.session_state.ufs_selecionadas)
@@ -404,11 +958,11 @@ class DashboardPIB:
         </div>
         """, unsafe_allow_html=True)
 
-        if df_filtrado.empty:
+        if df_totais.empty:
             st.error("Nenhum dado encontrado para a combinação de filtros. Tente uma seleção diferente.")
         else:
-            self.exibir_kpis(df_filtrado)
-            self.exibir_graficos(df_filtrado)
+            self.exibir_kpis(df_totais)
+            self.exibir_graficos(df_totais)
             
         st.markdown(f"<div class='footer'>Dashboard PIB Municípios | {datetime.now().strftime('%d/%m/%Y')}</div>", unsafe_allow_html=True)
 
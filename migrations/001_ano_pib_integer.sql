@@ -0,0 +1,18 @@
+-- ano_pib passa a ser INTEGER para que os filtros por período usem índice
+-- (um CAST na cláusula WHERE impedia o uso de qualquer índice na coluna).
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'pib_municipios'
+          AND column_name = 'ano_pib'
+          AND data_type <> 'integer'
+    ) THEN
+        ALTER TABLE pib_municipios
+            ALTER COLUMN ano_pib TYPE INTEGER USING CAST(ano_pib AS INTEGER);
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_pib_ano ON pib_municipios (ano_pib);
+CREATE INDEX IF NOT EXISTS idx_pib_mun ON pib_municipios (codigo_municipio_dv);
@@ -0,0 +1,34 @@
+-- Índice composto que cobre os filtros por período + município e as colunas somadas
+-- (index-only scan nas agregações).
+CREATE INDEX IF NOT EXISTS pib_ano_mun ON pib_municipios (ano_pib, codigo_municipio_dv)
+    INCLUDE (vl_pib, vl_pib_per_capta, vl_agropecuaria, vl_industria, vl_servicos, vl_administracao);
+
+-- Somas pré-agregadas por ano e UF, usadas quando nenhum município específico é selecionado.
+-- A média do PIB per capita é recomposta a partir de soma e contagem.
+-- Precisa ser atualizada a cada carga da tabela fato (ver README). modificacoes_fato guarda o contador de escritas
+-- de pib_municipios no momento do REFRESH; se o contador atual for diferente, o painel ignora a visão.
+CREATE MATERIALIZED VIEW IF NOT EXISTS pib_anual_uf AS
+SELECT
+    CAST(p.ano_pib AS INTEGER) AS ano_pib,
+    m.cd_uf,
+    SUM(p.vl_pib) AS vl_pib,
+    SUM(p.vl_pib_per_capta) AS soma_pib_per_capta,
+    COUNT(p.vl_pib_per_capta) AS qtd_pib_per_capta,
+    SUM(COALESCE(TRUNC(p.vl_pib / NULLIF(p.vl_pib_per_capta, 0)), 0)::integer) AS populacao_estimada,
+    COUNT(DISTINCT p.codigo_municipio_dv) AS num_municipios,
+    SUM(p.vl_agropecuaria) AS vl_agropecuaria,
+    SUM(p.vl_industria) AS vl_industria,
+    SUM(p.vl_servicos) AS vl_servicos,
+    SUM(p.vl_administracao) AS vl_administracao,
+    MAX(e.modificacoes_fato) AS modificacoes_fato
+FROM pib_municipios p
+JOIN municipio m ON p.codigo_municipio_dv = m.codigo_municipio_dv
+CROSS JOIN (
+    SELECT n_tup_ins + n_tup_upd + n_tup_del AS modificacoes_fato
+    FROM pg_stat_user_tables
+    WHERE relid = 'pib_municipios'::regclass
+) e
+GROUP BY 1, m.cd_uf;
+
+-- Necessário para o REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS pib_anual_uf_ano_uf ON pib_anual_uf (ano_pib, cd_uf);